@@ -0,0 +1,29 @@
+from pathlib import Path
+
+from onnxruntime.quantization import QuantType, quantize_dynamic
+from optimum.onnxruntime import ORTModelForFeatureExtraction
+from transformers import AutoTokenizer
+
+MODEL_NAME = "sentence-transformers/paraphrase-multilingual-MiniLM-L12-v2"
+ONNX_DIR = Path("onnx")
+
+def main():
+    ONNX_DIR.mkdir(parents=True, exist_ok=True)
+
+    # fp32-граф + токенизатор рядом (memory_service грузит токенизатор из этой же папки)
+    model = ORTModelForFeatureExtraction.from_pretrained(MODEL_NAME, export=True)
+    model.save_pretrained(ONNX_DIR)
+    AutoTokenizer.from_pretrained(MODEL_NAME).save_pretrained(ONNX_DIR)
+
+    # int8-веса для CPU: именно этот файл подхватывает memory_service
+    quantize_dynamic(
+        str(ONNX_DIR / "model.onnx"),
+        str(ONNX_DIR / "model_quantized.onnx"),
+        weight_type=QuantType.QInt8,
+    )
+
+    print("OK: ONNX-модель:", (ONNX_DIR / "model_quantized.onnx").resolve())
+    print("Перезапусти memory_service, чтобы он перешёл на onnxruntime")
+
+if __name__ == "__main__":
+    main()
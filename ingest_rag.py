@@ -1,10 +1,13 @@
-import re, hashlib
+import os, re, hashlib
+from concurrent.futures import ThreadPoolExecutor
 from pathlib import Path
 from datetime import datetime
 
 import chromadb
 from chromadb.config import Settings
+import torch
 from sentence_transformers import SentenceTransformer
+from transformers import AutoTokenizer
 
 BASE = Path('farm_memory')
 CHROMA_DIR = BASE / 'vector' / 'chroma'
@@ -13,13 +16,22 @@ MODEL_NAME = 'sentence-transformers/paraphrase-multilingual-MiniLM-L12-v2'
 
 SCAN_DIRS = [(BASE / 'knowledge','knowledge'), (BASE / 'journal','journal')]
 EXTS = {'.md', '.txt'}
+ENCODE_BATCH = 64
+PREP_WORKERS = 8
+# окно чанка в токенах: max_seq_length модели 128 минус <s>/</s> — иначе хвост чанка обрежется;
+# шаг 96 = перекрытие окон 25%
+CHUNK_TOKENS = 126
+CHUNK_STRIDE = 96
+ADD_BATCH = 4096
 
 def file_sha1(p: Path) -> str:
-    h = hashlib.sha1()
     with p.open('rb') as f:
+        if hasattr(hashlib, 'file_digest'):  # 3.11+: readinto в общий буфер, без GIL
+            return hashlib.file_digest(f, 'sha1').hexdigest()
+        h = hashlib.sha1()
         for b in iter(lambda: f.read(1024*1024), b''):
             h.update(b)
-    return h.hexdigest()
+        return h.hexdigest()
 
 def read_text(p: Path) -> str:
     try:
@@ -27,78 +39,124 @@ def read_text(p: Path) -> str:
     except UnicodeDecodeError:
         return p.read_text(encoding='cp1251', errors='replace')
 
+_WS = re.compile(r'[ \t]+')
+_NL = re.compile(r'\n{3,}')
+
 def normalize(t: str) -> str:
     t = t.replace('\r\n','\n')
-    t = re.sub(r'[ \t]+',' ', t)
-    t = re.sub(r'\n{3,}','\n\n', t)
+    t = _WS.sub(' ', t)
+    t = _NL.sub('\n\n', t)
     return t.strip()
 
-def chunk_text(t: str, size=900, overlap=150):
+def chunk_text(t: str, offs, size=CHUNK_TOKENS, stride=CHUNK_STRIDE):
+    """Скользящее окно по токенам; чанк — срез исходного текста по offsets токенов."""
     if not t: return []
-    out=[]; i=0; n=len(t)
-    while i<n:
+    out=[]; n=len(offs)
+    for i in range(0, n, stride):
         j=min(i+size,n)
-        out.append(t[i:j])
+        out.append(t[offs[i][0]:offs[j-1][1]])
         if j==n: break
-        i=max(0, j-overlap)
+    return out
+
+def scan_files():
+    for root, kind in SCAN_DIRS:
+        if not root.exists():
+            continue
+        for p in root.rglob('*'):
+            if p.is_file() and p.suffix.lower() in EXTS:
+                yield p, kind
+
+def prep_file(item):
+    """(path, kind) -> (rel, kind, sha, text) или None, если индексировать нечего."""
+    p, kind = item
+    text = normalize(read_text(p))
+    if len(text) < 20:
+        return None
+    sha = file_sha1(p)
+    rel = p.relative_to(BASE).as_posix()
+    return rel, kind, sha, text
+
+def chunk_files(read, tok):
+    """
+    (rel, kind, sha, text) | None -> [(rel, kind, sha, chunks)].
+    Все тексты — одним encode_batch: в tokenizers GIL отпускает только batch-вызов
+    (и он же сам параллелится по ядрам), одиночный encode держит GIL.
+    """
+    read = [x for x in read if x is not None]
+    encs = tok.encode_batch([x[3] for x in read], add_special_tokens=False)
+    out = []
+    for (rel, kind, sha, text), enc in zip(read, encs):
+        chunks = chunk_text(text, enc.offsets)
+        if chunks:
+            out.append((rel, kind, sha, chunks))
     return out
 
 def main():
     CHROMA_DIR.mkdir(parents=True, exist_ok=True)
     client = chromadb.PersistentClient(path=str(CHROMA_DIR), settings=Settings(anonymized_telemetry=False))
     col = client.get_or_create_collection(name=COLLECTION_NAME)
-    model = SentenceTransformer(MODEL_NAME)
-
-    added_files=0; added_chunks=0
 
-    for root, kind in SCAN_DIRS:
-        if not root.exists(): 
-            continue
-        for p in root.rglob('*'):
-            if not p.is_file(): 
-                continue
-            if p.suffix.lower() not in EXTS:
-                continue
-            text = normalize(read_text(p))
-            if len(text) < 20:
-                continue
-
-            sha = file_sha1(p)
-            rel = p.relative_to(BASE).as_posix()
-            chunks = chunk_text(text)
-            if not chunks:
-                continue
-
-            # remove old chunks for that file
-            try:
-                existing = col.get(where={'source_path': rel})
-                if existing and existing.get('ids'):
-                    col.delete(ids=existing['ids'])
-            except Exception:
-                pass
-
-            ids=[]; docs=[]; metas=[]
-            for idx, ch in enumerate(chunks):
-                ids.append(f'{rel}::#{idx}::{sha[:8]}')
-                docs.append(ch)
-                metas.append({
-                    'source_path': rel,
-                    'kind': kind,
-                    'file_sha1': sha,
-                    'chunk_index': idx,
-                    'ingested_at': datetime.utcnow().isoformat(timespec='seconds')+'Z'
-                })
-
-            embs = model.encode(docs, normalize_embeddings=True).tolist()
-            col.add(ids=ids, documents=docs, metadatas=metas, embeddings=embs)
-
-            added_files += 1
-            added_chunks += len(chunks)
+    # Rust-токенизатор напрямую (fast): offsets токенов без обёртки transformers
+    tok = AutoTokenizer.from_pretrained(MODEL_NAME).backend_tokenizer
+    tok.no_truncation()
+    tok.no_padding()
+
+    # чтение/хэш/нормализация файлов идут в пуле (файловый I/O и hashlib отпускают GIL),
+    # за ними в том же пуле — токенизация одним encode_batch; всё это — пока грузится модель.
+    # encode модели остаётся в главном потоке
+    with ThreadPoolExecutor(max_workers=PREP_WORKERS) as ex:
+        read = ex.map(prep_file, list(scan_files()))
+        prepared = ex.submit(chunk_files, read, tok)
+
+        # по умолчанию torch часто берёт не все ядра
+        torch.set_num_threads(os.cpu_count() or 1)
+        model = SentenceTransformer(MODEL_NAME)
+
+        prepared = prepared.result()
+
+    added_files=0
+    pending=[]  # (rel, kind, sha, idx, chunk) по всем файлам -> один encode;
+    # encode сам сортирует входы по длине, так что паддинг внутри батча минимален
+
+    for rel, kind, sha, chunks in prepared:
+        # remove old chunks for that file
+        try:
+            existing = col.get(where={'source_path': rel})
+            if existing and existing.get('ids'):
+                col.delete(ids=existing['ids'])
+        except Exception:
+            pass
+
+        for idx, ch in enumerate(chunks):
+            pending.append((rel, kind, sha, idx, ch))
+        added_files += 1
+
+    if pending:
+        docs = [x[4] for x in pending]
+        embs = model.encode(docs, batch_size=ENCODE_BATCH, show_progress_bar=True,
+                            normalize_embeddings=True, convert_to_numpy=True).tolist()
+
+        now = datetime.utcnow().isoformat(timespec='seconds')+'Z'
+        ids=[]; metas=[]
+        for rel, kind, sha, idx, ch in pending:
+            ids.append(f'{rel}::#{idx}::{sha[:8]}')
+            metas.append({
+                'source_path': rel,
+                'kind': kind,
+                'file_sha1': sha,
+                'chunk_index': idx,
+                'ingested_at': now
+            })
+
+        # у chroma есть лимит на размер одного add
+        for i in range(0, len(ids), ADD_BATCH):
+            j = i + ADD_BATCH
+            col.add(ids=ids[i:j], documents=docs[i:j], metadatas=metas[i:j], embeddings=embs[i:j])
 
     if added_files == 0:
         print('Нечего индексировать: добавь .md/.txt в farm_memory/knowledge или journal')
     else:
-        print(f'OK: проиндексировано файлов: {added_files}, чанков: {added_chunks}')
+        print(f'OK: проиндексировано файлов: {added_files}, чанков: {len(pending)}')
         print('Chroma:', CHROMA_DIR.resolve(), 'collection:', COLLECTION_NAME)
 
 if __name__=='__main__':
@@ -1,9 +1,12 @@
-import re, hashlib, sqlite3
+import os, re, hashlib, sqlite3, uuid
+from concurrent.futures import ThreadPoolExecutor
 from pathlib import Path
 from datetime import datetime
 
 import numpy as np
+import torch
 from sentence_transformers import SentenceTransformer
+from transformers import AutoTokenizer
 
 BASE = Path("farm_memory")
 DB_PATH = BASE / "db" / "rag.db"
@@ -11,13 +14,29 @@ DB_PATH = BASE / "db" / "rag.db"
 MODEL_NAME = "sentence-transformers/paraphrase-multilingual-MiniLM-L12-v2"
 SCAN_DIRS = [(BASE / "knowledge","knowledge"), (BASE / "journal","journal")]
 EXTS = {".md", ".txt"}
+ENCODE_BATCH = 64
+PREP_WORKERS = 8
+# окно чанка в токенах: max_seq_length модели 128 минус <s>/</s> — иначе хвост чанка обрежется;
+# шаг 96 = перекрытие окон 25%
+CHUNK_TOKENS = 126
+CHUNK_STRIDE = 96
+INSERT_BATCH = 50_000
+SQL_VARS = 500  # параметров в одном IN (...)
+
+# вторичные индексы rag_chunks (как в init_rag_db.py): на время первой заливки в пустую таблицу снимаем
+SECONDARY_INDEXES = {
+    "idx_rag_source": "CREATE INDEX IF NOT EXISTS idx_rag_source ON rag_chunks(source_path)",
+    "idx_rag_kind": "CREATE INDEX IF NOT EXISTS idx_rag_kind ON rag_chunks(kind)",
+}
 
 def file_sha1(p: Path) -> str:
-    h = hashlib.sha1()
     with p.open("rb") as f:
+        if hasattr(hashlib, "file_digest"):  # 3.11+: readinto в общий буфер, без GIL
+            return hashlib.file_digest(f, "sha1").hexdigest()
+        h = hashlib.sha1()
         for b in iter(lambda: f.read(1024*1024), b""):
             h.update(b)
-    return h.hexdigest()
+        return h.hexdigest()
 
 def read_text(p: Path) -> str:
     try:
@@ -25,83 +44,230 @@ def read_text(p: Path) -> str:
     except UnicodeDecodeError:
         return p.read_text(encoding="cp1251", errors="replace")
 
+_WS = re.compile(r"[ \t]+")
+_NL = re.compile(r"\n{3,}")
+
 def normalize(t: str) -> str:
     t = t.replace("\r\n","\n")
-    t = re.sub(r"[ \t]+"," ", t)
-    t = re.sub(r"\n{3,}","\n\n", t)
+    t = _WS.sub(" ", t)
+    t = _NL.sub("\n\n", t)
     return t.strip()
 
-def chunk_text(t: str, size=900, overlap=150):
+def chunk_text(t: str, offs, size=CHUNK_TOKENS, stride=CHUNK_STRIDE):
+    """Скользящее окно по токенам; чанк — срез исходного текста по offsets токенов."""
     if not t: return []
-    out=[]; i=0; n=len(t)
-    while i<n:
+    out=[]; n=len(offs)
+    for i in range(0, n, stride):
         j=min(i+size,n)
-        out.append(t[i:j])
+        out.append(t[offs[i][0]:offs[j-1][1]])
         if j==n: break
-        i=max(0, j-overlap)
     return out
 
 def to_blob(vec: np.ndarray) -> bytes:
     return vec.astype(np.float32).tobytes()
 
+def scan_files():
+    for root, kind in SCAN_DIRS:
+        if not root.exists():
+            continue
+        for p in root.rglob("*"):
+            if p.is_file() and p.suffix.lower() in EXTS:
+                yield p, kind
+
+def prep_file(item):
+    """(path, kind) -> (rel, kind, sha, text) или None, если индексировать нечего."""
+    p, kind = item
+    text = normalize(read_text(p))
+    if len(text) < 20:
+        return None
+    sha = file_sha1(p)
+    rel = p.relative_to(BASE).as_posix()
+    return rel, kind, sha, text
+
+def chunk_files(read, tok):
+    """
+    (rel, kind, sha, text) | None -> [(rel, kind, sha, chunks)].
+    Все тексты — одним encode_batch: в tokenizers GIL отпускает только batch-вызов
+    (и он же сам параллелится по ядрам), одиночный encode держит GIL.
+    """
+    read = [x for x in read if x is not None]
+    encs = tok.encode_batch([x[3] for x in read], add_special_tokens=False)
+    out = []
+    for (rel, kind, sha, text), enc in zip(read, encs):
+        chunks = chunk_text(text, enc.offsets)
+        if chunks:
+            out.append((rel, kind, sha, chunks))
+    return out
+
+def _db_connect() -> sqlite3.Connection:
+    # транзакции ведём руками: BEGIN IMMEDIATE ... COMMIT
+    con = sqlite3.connect(DB_PATH, isolation_level=None)
+    con.executescript("""
+        PRAGMA journal_mode=WAL;
+        PRAGMA synchronous=NORMAL;
+        PRAGMA temp_store=MEMORY;
+        PRAGMA cache_size=-200000;
+
+        -- эмбеддинги по sha1(модель + текст чанка): неизменённые чанки не перекодируем
+        CREATE TABLE IF NOT EXISTS emb_cache (
+          key BLOB PRIMARY KEY,
+          model TEXT NOT NULL,
+          emb BLOB NOT NULL
+        );
+    """)
+    return con
+
+def cache_key(text: str) -> bytes:
+    return hashlib.sha1((MODEL_NAME + "\x00" + text).encode("utf-8")).digest()
+
+def encode_cached(con: sqlite3.Connection, model, texts):
+    """
+    Эмбеддинги texts: попадания берём из emb_cache, в model.encode уходят только промахи.
+    -> (embs (N, D) float32, keys, промахов) ; keys[i] — ключ кэша для texts[i]
+    """
+    keys = [cache_key(t) for t in texts]
+    uniq = list(dict.fromkeys(keys))
+
+    hits = {}
+    for i in range(0, len(uniq), SQL_VARS):
+        part = uniq[i:i+SQL_VARS]
+        hits.update(con.execute(
+            f"SELECT key, emb FROM emb_cache WHERE key IN ({','.join('?' * len(part))})", part
+        ))
+
+    miss = {}
+    for k, t in zip(keys, texts):
+        if k not in hits:
+            miss.setdefault(k, t)
+
+    if miss:
+        fresh = model.encode(list(miss.values()), batch_size=ENCODE_BATCH, show_progress_bar=True,
+                             normalize_embeddings=True, convert_to_numpy=True)
+        fresh = np.asarray(fresh, dtype=np.float32)
+        for k, v in zip(miss, fresh):
+            hits[k] = to_blob(v)
+
+    print(f"emb_cache: попаданий {len(uniq) - len(miss)}, закодировано {len(miss)}")
+
+    embs = np.frombuffer(b"".join(hits[k] for k in keys), dtype=np.float32).reshape(len(keys), -1)
+    return embs, keys, len(miss)
+
 def main():
     DB_PATH.parent.mkdir(parents=True, exist_ok=True)
-    con = sqlite3.connect(DB_PATH)
+    con = _db_connect()
     cur = con.cursor()
 
-    model = SentenceTransformer(MODEL_NAME)
+    if not cur.execute("SELECT 1 FROM sqlite_master WHERE type='table' AND name='rag_embs'").fetchone():
+        raise SystemExit("Нет таблицы rag_embs: сначала запусти init_rag_db.py (создаст/мигрирует схему)")
+    # натуральный ключ для UPSERT (тот же индекс создаёт memory_service)
+    cur.execute(
+        "CREATE UNIQUE INDEX IF NOT EXISTS ux_rag_chunks_sp_kind_idx "
+        "ON rag_chunks(source_path, kind, chunk_index)"
+    )
 
-    added_files = 0
-    added_chunks = 0
+    # Rust-токенизатор напрямую (fast): offsets токенов без обёртки transformers
+    tok = AutoTokenizer.from_pretrained(MODEL_NAME).backend_tokenizer
+    tok.no_truncation()
+    tok.no_padding()
 
-    for root, kind in SCAN_DIRS:
-        if not root.exists():
-            continue
+    # чтение/хэш/нормализация файлов идут в пуле (файловый I/O и hashlib отпускают GIL),
+    # за ними в том же пуле — токенизация одним encode_batch; всё это — пока грузится модель.
+    # encode модели остаётся в главном потоке
+    with ThreadPoolExecutor(max_workers=PREP_WORKERS) as ex:
+        read = ex.map(prep_file, list(scan_files()))
+        prepared = ex.submit(chunk_files, read, tok)
 
-        for p in root.rglob("*"):
-            if not p.is_file(): 
-                continue
-            if p.suffix.lower() not in EXTS:
-                continue
+        # по умолчанию torch часто берёт не все ядра
+        torch.set_num_threads(os.cpu_count() or 1)
+        model = SentenceTransformer(MODEL_NAME)
 
-            text = normalize(read_text(p))
-            if len(text) < 20:
-                continue
+        prepared = prepared.result()
 
-            sha = file_sha1(p)
-            rel = p.relative_to(BASE).as_posix()
-            chunks = chunk_text(text)
-            if not chunks:
-                continue
+    added_files = 0
+    pending = []  # (rel, kind, sha, idx, chunk) по всем файлам -> один encode;
+    # encode сам сортирует входы по длине, так что паддинг внутри батча минимален
 
-            cur.execute("DELETE FROM rag_chunks WHERE source_path=?", (rel,))
+    for rel, kind, sha, chunks in prepared:
+        for idx, ch in enumerate(chunks):
+            pending.append((rel, kind, sha, idx, ch))
+        added_files += 1
 
-            embs = model.encode(chunks, normalize_embeddings=True)
-            embs = np.asarray(embs, dtype=np.float32)
-            dim = int(embs.shape[1])
+    if pending:
+        embs, keys, n_miss = encode_cached(con, model, [x[4] for x in pending])
+        dim = int(embs.shape[1])
 
-            now = datetime.utcnow().isoformat(timespec="seconds")+"Z"
+        now = datetime.utcnow().isoformat(timespec="seconds")+"Z"
 
-            rows = []
-            for idx, ch in enumerate(chunks):
-                doc_id = f"{rel}::#{idx}::{sha[:8]}"
-                rows.append((doc_id, rel, kind, idx, ch, to_blob(embs[idx]), dim, now))
+        rows = []; emb_rows = []; n_chunks = {}
+        for i, (rel, kind, sha, idx, ch) in enumerate(pending):
+            doc_id = f"{rel}::#{idx}::{sha[:8]}"
+            rows.append((doc_id, rel, kind, idx, ch, dim, now))
+            emb_rows.append((to_blob(embs[i]), rel, kind, idx))
+            n_chunks[(rel, kind)] = idx + 1
 
-            cur.executemany("""
-                INSERT INTO rag_chunks(id, source_path, kind, chunk_index, text, emb, dim, created_at)
-                VALUES(?,?,?,?,?,?,?,?)
-            """, rows)
+        # одна транзакция на всё: без fsync на каждый файл,
+        # и сервис не увидит наполовину перезаписанную базу
+        cur.execute("BEGIN IMMEDIATE")
+        try:
+            # повторный ingest без правок не должен ничего переписывать: смотрим на total_changes
+            changes0 = con.total_changes
+            # снимать/пересоздавать индексы имеет смысл только при заливке в пустую таблицу,
+            # иначе это перестройка индексов по всей таблице ради нескольких строк
+            bulk = cur.execute("SELECT 1 FROM rag_chunks LIMIT 1").fetchone() is None
+            # файл стал короче -> лишние хвостовые чанки; строки rag_embs удаляет триггер trg_rag_chunks_delete_emb
+            cur.executemany(
+                "DELETE FROM rag_chunks WHERE source_path=? AND kind=? AND chunk_index>=?",
+                ((rel, kind, n) for (rel, kind), n in n_chunks.items()),
+            )
+            if bulk:
+                for name in SECONDARY_INDEXES:
+                    cur.execute(f"DROP INDEX IF EXISTS {name}")
+            # UPSERT по (source_path, kind, chunk_index) вместо DELETE+INSERT: строка и её id остаются,
+            # неизменённые чанки (тот же text / emb) не переписываются вовсе
+            for i in range(0, len(rows), INSERT_BATCH):
+                cur.executemany("""
+                    INSERT INTO rag_chunks(id, source_path, kind, chunk_index, text, dim, created_at)
+                    VALUES(?,?,?,?,?,?,?)
+                    ON CONFLICT(source_path, kind, chunk_index) DO UPDATE SET
+                        text = excluded.text,
+                        dim = excluded.dim,
+                        created_at = excluded.created_at
+                    WHERE text IS NOT excluded.text OR dim IS NOT excluded.dim
+                """, rows[i:i+INSERT_BATCH])
+                cur.executemany("""
+                    INSERT INTO rag_embs(id, emb)
+                    SELECT id, ? FROM rag_chunks WHERE source_path=? AND kind=? AND chunk_index=?
+                    ON CONFLICT(id) DO UPDATE SET emb = excluded.emb
+                    WHERE emb IS NOT excluded.emb
+                """, emb_rows[i:i+INSERT_BATCH])
+            if bulk:
+                for ddl in SECONDARY_INDEXES.values():
+                    cur.execute(ddl)
+            changed = con.total_changes != changes0
 
-            added_files += 1
-            added_chunks += len(chunks)
+            if changed or n_miss:
+                # кэш = чанки текущего корпуса: так он не растёт от правок журналов
+                cur.execute("DELETE FROM emb_cache WHERE model=?", (MODEL_NAME,))
+                cache_rows = {k: (k, MODEL_NAME, emb_rows[i][0]) for i, k in enumerate(keys)}
+                cur.executemany("INSERT OR REPLACE INTO emb_cache(key, model, emb) VALUES(?,?,?)", cache_rows.values())
+            if changed:
+                # кэш матрицы эмбеддингов в memory_service привязан к emb_rev -> после ingest пересоберётся
+                cur.execute("CREATE TABLE IF NOT EXISTS rag_meta (key TEXT PRIMARY KEY, value TEXT NOT NULL)")
+                cur.execute("""
+                    INSERT INTO rag_meta(key, value) VALUES('emb_rev', ?)
+                    ON CONFLICT(key) DO UPDATE SET value = excluded.value
+                """, (uuid.uuid4().hex,))
+            cur.execute("COMMIT")
+        except BaseException:
+            cur.execute("ROLLBACK")
+            raise
 
-    con.commit()
     con.close()
 
     if added_files == 0:
         print("Нечего индексировать: добавь .md/.txt в farm_memory/knowledge или journal")
     else:
-        print(f"OK: проиндексировано файлов: {added_files}, чанков: {added_chunks}")
+        print(f"OK: проиндексировано файлов: {added_files}, чанков: {len(pending)}")
         print("DB:", DB_PATH.resolve())
 
 if __name__=="__main__":
@@ -16,15 +16,52 @@ CREATE TABLE IF NOT EXISTS rag_chunks (
   kind TEXT NOT NULL,
   chunk_index INTEGER NOT NULL,
   text TEXT NOT NULL,
-  emb BLOB NOT NULL,
   dim INTEGER NOT NULL,
   created_at TEXT NOT NULL
 );
 
 CREATE INDEX IF NOT EXISTS idx_rag_source ON rag_chunks(source_path);
 CREATE INDEX IF NOT EXISTS idx_rag_kind ON rag_chunks(kind);
+-- натуральный ключ: ingest и memory_service /store делают UPSERT по нему
+CREATE UNIQUE INDEX IF NOT EXISTS ux_rag_chunks_sp_kind_idx ON rag_chunks(source_path, kind, chunk_index);
+
+-- эмбеддинги отдельно от метаданных: выборки по rag_chunks не тащат BLOB-страницы
+CREATE TABLE IF NOT EXISTS rag_embs (
+  id TEXT PRIMARY KEY,
+  emb BLOB NOT NULL
+);
+
+CREATE TRIGGER IF NOT EXISTS trg_rag_chunks_delete_emb AFTER DELETE ON rag_chunks
+BEGIN
+  DELETE FROM rag_embs WHERE id = old.id;
+END;
+
+-- emb_rev: ревизия эмбеддингов, к ней привязан кэш матрицы в farm_memory/vector
+CREATE TABLE IF NOT EXISTS rag_meta (
+  key TEXT PRIMARY KEY,
+  value TEXT NOT NULL
+);
+
+-- кэш эмбеддингов ingest: key = sha1(модель + текст чанка)
+CREATE TABLE IF NOT EXISTS emb_cache (
+  key BLOB PRIMARY KEY,
+  model TEXT NOT NULL,
+  emb BLOB NOT NULL
+);
 """)
 
+# миграция со старой схемы: emb жил колонкой в rag_chunks
+cols = [r[1] for r in cur.execute("PRAGMA table_info(rag_chunks)")]
+if "emb" in cols:
+    cur.executescript("""
+    BEGIN;
+    INSERT OR REPLACE INTO rag_embs(id, emb) SELECT id, emb FROM rag_chunks;
+    ALTER TABLE rag_chunks DROP COLUMN emb;
+    DELETE FROM rag_meta WHERE key = 'emb_rev';
+    COMMIT;
+    """)
+    print("OK: rag_chunks.emb перенесён в rag_embs")
+
 con.commit()
 con.close()
 
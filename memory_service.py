@@ -1,29 +1,83 @@
 from __future__ import annotations
 
-from dataclasses import dataclass
+from dataclasses import dataclass, replace
 from pathlib import Path
+import os
 import sqlite3
+import threading
 import time
-from typing import List, Optional
+from typing import Any, Callable, Dict, List, Optional, Tuple, Union
 
 from datetime import datetime, timezone
 import uuid
 
 import numpy as np
+import torch
 from fastapi import FastAPI, HTTPException
 from pydantic import BaseModel, Field
 from sentence_transformers import SentenceTransformer
 
+try:
+    import numba
+    from numba import njit, prange
+
+    # /retrieve идёт из пула потоков FastAPI, parallel-ядра зовутся конкурентно:
+    # только tbb / omp; workqueue на этом валит процесс. Не загрузится — см. _check_numba
+    numba.config.THREADING_LAYER = "threadsafe"
+except ImportError:  # numba необязателен: без него — GEMV + argpartition
+    numba = None
+
+try:
+    import onnxruntime as ort
+    from transformers import AutoTokenizer
+except ImportError:  # onnxruntime необязателен: без него — SentenceTransformer на torch
+    ort = None
+
+try:
+    import faiss
+except ImportError:  # faiss необязателен: без него большие индексы идут через int8-проход
+    faiss = None
+
+# сервис только считает эмбеддинги: autograd не нужен, потоков — сколько есть ядер
+torch.set_num_threads(os.cpu_count() or 1)
+torch.set_grad_enabled(False)
+
 
 # ----------------------------
 # Config
 # ----------------------------
 BASE = Path("farm_memory")
 DB_PATH = BASE / "db" / "rag.db"
+# кэш матрицы эмбеддингов: сырой float32 (N, D) в порядке rowid rag_chunks.
+# Источник истины — БД; файл привязан к rag_meta.emb_rev и пересобирается, когда rev меняется.
+# Рядом emb.<rev>.writes — rag_meta.emb_writes на момент последней записи в файл: /store коммитит БД
+# раньше, чем пишет строку кэша, и после сбоя между ними счётчики не сойдутся -> пересборка.
+VECTOR_DIR = BASE / "vector"
 MODEL_NAME = "sentence-transformers/paraphrase-multilingual-MiniLM-L12-v2"
+# ONNX-экспорт той же модели (см. export_onnx.py); если он есть и стоит onnxruntime — encode через ORT
+ONNX_MODEL = Path("onnx") / "model_quantized.onnx"
+MAX_SEQ_LENGTH = 128  # max_seq_length модели
 
 PRIORITIES = {"normal", "high"}
 
+# грубый поиск по int8-копии матрицы (в 4 раза меньше байт за проход, numba-ядро int8 x int8 -> int32),
+# точные fp32-скоры только для кандидатов; на малых N и без numba — сразу fp32
+QUANT_MIN_ROWS = 50_000
+RERANK_TOPN = 50
+# кандидатов на пересчёт: max(RERANK_TOPN, CAND_OVERSAMPLE * topk) — и для int8, и для HNSW
+CAND_OVERSAMPLE = 4
+I8_BLOCK = 8192
+# сколько блоков строк делит между потоками numba-ядро top-k
+NUMBA_BLOCKS_PER_THREAD = 4
+# от ANN_MIN_ROWS строк (и с faiss) запросы без фильтра идут через HNSW-граф:
+# кандидаты из графа, затем точный fp32-пересчёт
+ANN_MIN_ROWS = 50_000
+HNSW_M = 32
+HNSW_EF_SEARCH = 128
+# строки, дописанные или перезаписанные /store после сборки графа, ищутся перебором;
+# когда их больше этой доли — граф пересобирается в фоне (а при загрузке старый не берётся)
+ANN_MAX_TAIL = 0.1
+
 
 # ----------------------------
 # API models
@@ -69,14 +123,70 @@ class RagIndex:
     chunk_index: List[int]
     priority: List[str]
     text: List[str]
-    emb_matrix: np.ndarray  # (N, D) float32 normalized
+    emb_matrix: np.ndarray  # (N, D) float32 normalized (обычно np.memmap на кэш-файл)
+    emb_rev: str
+    emb_i8: Optional[np.ndarray]  # (N, D) int8, round(emb * 127) — для грубого прохода; None, пока он не нужен
+    kind_codes: np.ndarray  # (N,) int16, коды kind для векторного фильтра
+    kind_vocab: Dict[str, int]
+    row_of: Dict[Tuple[str, str, int], int]  # (source_path, kind, chunk_index) -> строка матрицы
+    ann: Optional[Any]  # faiss HNSW по строкам [0, ann.ntotal); None — без ANN
+    ann_stale: np.ndarray  # (S,) int64, строки графа, перезаписанные /store после его сборки
+    ann_rows: int  # строк в графе — готовом или строящемся в фоне; 0 — без ANN
+
+
+# ----------------------------
+# Encoders
+# ----------------------------
+class OnnxEncoder:
+    """
+    encode() как у SentenceTransformer, но на ONNX Runtime:
+    токенизация HF fast tokenizer, mean pooling по attention_mask (как в исходной модели).
+    """
+
+    def __init__(self, model_path: Path) -> None:
+        opts = ort.SessionOptions()
+        opts.graph_optimization_level = ort.GraphOptimizationLevel.ORT_ENABLE_ALL
+        opts.intra_op_num_threads = os.cpu_count() or 1
+        self.session = ort.InferenceSession(str(model_path), opts, providers=["CPUExecutionProvider"])
+        self.input_names = {i.name for i in self.session.get_inputs()}
+        self.tokenizer = AutoTokenizer.from_pretrained(str(model_path.parent))
+
+    def encode(self, texts: List[str], normalize_embeddings: bool = False) -> np.ndarray:
+        enc = self.tokenizer(
+            list(texts), padding=True, truncation=True, max_length=MAX_SEQ_LENGTH, return_tensors="np"
+        )
+        feeds = {k: v.astype(np.int64) for k, v in enc.items() if k in self.input_names}
+        hidden = self.session.run(None, feeds)[0]  # (B, T, H) last_hidden_state
+
+        mask = enc["attention_mask"][:, :, None].astype(np.float32)
+        emb = (hidden * mask).sum(axis=1) / np.maximum(mask.sum(axis=1), 1e-9)
+        if normalize_embeddings:
+            emb /= np.maximum(np.linalg.norm(emb, axis=1, keepdims=True), 1e-12)
+        return emb.astype(np.float32, copy=False)
+
+
+Encoder = Union[SentenceTransformer, OnnxEncoder]
+
+
+def _load_encoder() -> Encoder:
+    if ort is not None and ONNX_MODEL.exists():
+        return OnnxEncoder(ONNX_MODEL)
+
+    model = SentenceTransformer(MODEL_NAME, device="cuda" if torch.cuda.is_available() else "cpu")
+    model.eval()
+    return model
 
 
 class AppState:
     def __init__(self) -> None:
-        self.model: Optional[SentenceTransformer] = None
+        self.model: Optional[Encoder] = None
         self.index: Optional[RagIndex] = None
         self.loaded_at: Optional[float] = None
+        # /store и /reload_index меняют индекс — по одному
+        self.write_lock = threading.Lock()
+        # (emb_rev, поколение) текущей фоновой сборки HNSW; сборка с другим job бросает работу
+        self.ann_job: Optional[Tuple[str, int]] = None
+        self.ann_gen = 0
 
     def ready(self) -> bool:
         return self.model is not None and self.index is not None
@@ -90,7 +200,10 @@ app = FastAPI()
 # DB / loading
 # ----------------------------
 def _db_connect() -> sqlite3.Connection:
-    return sqlite3.connect(DB_PATH, check_same_thread=False, timeout=1.0)
+    con = sqlite3.connect(DB_PATH, check_same_thread=False, timeout=1.0)
+    # BLOB-страницы rag_embs читаются из page cache ОС без read() в буфер sqlite
+    con.execute("PRAGMA mmap_size = 1073741824")
+    return con
 
 
 def _has_column(con: sqlite3.Connection, table: str, col: str) -> bool:
@@ -104,6 +217,8 @@ def _ensure_schema(con: sqlite3.Connection) -> None:
     """
     1) UNIQUE индекс для UPSERT по натуральному ключу
     2) priority column (migration) если её нет
+    3) rag_meta (emb_rev для кэша матрицы эмбеддингов)
+    4) rag_embs: эмбеддинги отдельной таблицей (migration из rag_chunks.emb)
     """
     con.execute(
         "CREATE UNIQUE INDEX IF NOT EXISTS ux_rag_chunks_sp_kind_idx "
@@ -113,8 +228,288 @@ def _ensure_schema(con: sqlite3.Connection) -> None:
     if not _has_column(con, "rag_chunks", "priority"):
         con.execute("ALTER TABLE rag_chunks ADD COLUMN priority TEXT NOT NULL DEFAULT 'normal'")
 
+    con.execute("CREATE TABLE IF NOT EXISTS rag_meta (key TEXT PRIMARY KEY, value TEXT NOT NULL)")
+
+    con.execute("CREATE TABLE IF NOT EXISTS rag_embs (id TEXT PRIMARY KEY, emb BLOB NOT NULL)")
+    con.execute(
+        "CREATE TRIGGER IF NOT EXISTS trg_rag_chunks_delete_emb AFTER DELETE ON rag_chunks "
+        "BEGIN DELETE FROM rag_embs WHERE id = old.id; END"
+    )
+    if _has_column(con, "rag_chunks", "emb"):
+        con.execute("INSERT OR REPLACE INTO rag_embs(id, emb) SELECT id, emb FROM rag_chunks")
+        con.execute("ALTER TABLE rag_chunks DROP COLUMN emb")
+        _bump_emb_rev(con)
+
+
+def _bump_emb_rev(con: sqlite3.Connection) -> str:
+    rev = uuid.uuid4().hex
+    con.execute(
+        "INSERT INTO rag_meta(key, value) VALUES('emb_rev', ?) "
+        "ON CONFLICT(key) DO UPDATE SET value = excluded.value",
+        (rev,),
+    )
+    return rev
+
+
+def _get_emb_rev(con: sqlite3.Connection) -> str:
+    row = con.execute("SELECT value FROM rag_meta WHERE key='emb_rev'").fetchone()
+    if row:
+        return str(row[0])
+    return _bump_emb_rev(con)
+
+
+def _bump_emb_writes(con: sqlite3.Connection) -> int:
+    # в той же транзакции, что и запись эмбеддинга /store
+    con.execute(
+        "INSERT INTO rag_meta(key, value) VALUES('emb_writes', '1') "
+        "ON CONFLICT(key) DO UPDATE SET value = CAST(value AS INTEGER) + 1"
+    )
+    return _get_emb_writes(con)
+
+
+def _get_emb_writes(con: sqlite3.Connection) -> int:
+    row = con.execute("SELECT value FROM rag_meta WHERE key='emb_writes'").fetchone()
+    return int(row[0]) if row else 0
+
 
-def _load_index_from_db() -> RagIndex:
+def _emb_cache_path(rev: str) -> Path:
+    return VECTOR_DIR / f"emb.{rev}.f32"
+
+
+def _emb_writes_path(rev: str) -> Path:
+    return VECTOR_DIR / f"emb.{rev}.writes"
+
+
+def _save_emb_writes(rev: str, writes: int) -> None:
+    _emb_writes_path(rev).write_text(str(writes))
+
+
+def _open_emb_cache(rev: str, n: int, dim: int, writes: int) -> Optional[np.ndarray]:
+    try:
+        if int(_emb_writes_path(rev).read_text()) != writes:
+            return None
+    except (OSError, ValueError):
+        return None
+    return _map_emb_cache(rev, n, dim)
+
+
+def _map_emb_cache(rev: str, n: int, dim: int) -> Optional[np.ndarray]:
+    p = _emb_cache_path(rev)
+    try:
+        if p.stat().st_size != n * dim * 4:
+            return None
+    except FileNotFoundError:
+        return None
+    return np.memmap(p, dtype=np.float32, mode="r", shape=(n, dim))
+
+
+def _save_emb_cache(rev: str, emb_matrix: np.ndarray, writes: int) -> np.ndarray:
+    """
+    Пишет матрицу в кэш-файл и возвращает memmap на него.
+    Кэш best-effort: если записать не вышло — остаёмся на матрице в памяти.
+    """
+    p = _emb_cache_path(rev)
+    tmp = p.with_suffix(".tmp")
+    try:
+        VECTOR_DIR.mkdir(parents=True, exist_ok=True)
+        emb_matrix.astype(np.float32, copy=False).tofile(tmp)
+        os.replace(tmp, p)
+        _save_emb_writes(rev, writes)
+    except OSError:
+        return emb_matrix
+
+    _remove_stale("emb.*.f32", keep=p)
+    _remove_stale("emb.*.writes", keep=_emb_writes_path(rev))
+    return np.memmap(p, dtype=np.float32, mode="r", shape=emb_matrix.shape)
+
+
+def _remove_stale(pattern: str, keep: Path) -> None:
+    # старые ревизии; под Windows замапленный файл не удалится — не страшно
+    for old in VECTOR_DIR.glob(pattern):
+        if old != keep:
+            try:
+                old.unlink()
+            except OSError:
+                pass
+
+
+def _ann_path(rev: str) -> Path:
+    return VECTOR_DIR / f"hnsw.{rev}.faiss"
+
+
+def _ann_stale_path(rev: str) -> Path:
+    # int64 номера строк, перезаписанных после сохранения графа hnsw.<rev>.faiss
+    return VECTOR_DIR / f"hnsw.{rev}.stale"
+
+
+def _use_ann(n: int) -> bool:
+    return faiss is not None and n >= ANN_MIN_ROWS
+
+
+def _open_ann(rev: str, n: int, dim: int) -> Tuple[Optional[Any], np.ndarray]:
+    """
+    Сохранённый HNSW-граф ревизии rev и список его устаревших строк.
+    Граф берём, если он покрывает префикс матрицы и хвост вместе с устаревшими строками
+    не слишком длинный; иначе (None, []) — граф будет строиться заново (_build_ann).
+    """
+    no_stale = np.empty(0, dtype=np.int64)
+    p = _ann_path(rev)
+    sp = _ann_stale_path(rev)
+    if p.exists():
+        ann = faiss.read_index(str(p))
+        stale = no_stale
+        if sp.exists():
+            stale = np.unique(np.fromfile(sp, dtype=np.int64))
+            stale = stale[stale < ann.ntotal]
+        if ann.d == dim and ann.ntotal <= n and not _ann_tail_too_long(n, ann.ntotal, stale.shape[0]):
+            ann.hnsw.efSearch = HNSW_EF_SEARCH
+            return ann, stale
+
+    # отметки в .stale относятся к старому графу; без него их нельзя оставлять
+    _drop_ann(rev)
+    return None, no_stale
+
+
+def _ann_tail_too_long(n: int, ntotal: int, n_stale: int) -> bool:
+    return n - ntotal + n_stale > n * ANN_MAX_TAIL
+
+
+def _drop_ann(rev: str) -> None:
+    for old in (_ann_path(rev), _ann_stale_path(rev)):
+        try:
+            old.unlink()
+        except OSError:
+            pass
+
+
+def _build_ann(emb_matrix: np.ndarray, live: Callable[[], bool]) -> Optional[Any]:
+    """
+    HNSW-граф (inner product = косинус на нормализованных векторах) по строкам emb_matrix.
+    live() проверяется между блоками: сборка, которую обогнала новая, возвращает None.
+    """
+    n, dim = emb_matrix.shape
+    ann = faiss.IndexHNSWFlat(dim, HNSW_M, faiss.METRIC_INNER_PRODUCT)
+    for i in range(0, n, I8_BLOCK):
+        if not live():
+            return None
+        ann.add(np.ascontiguousarray(emb_matrix[i:i + I8_BLOCK]))
+    ann.hnsw.efSearch = HNSW_EF_SEARCH
+    return ann
+
+
+def _ann_worker(job: Tuple[str, int], emb_matrix: np.ndarray, stale_from: int) -> None:
+    rev = job[0]
+    ann = _build_ann(emb_matrix, lambda: state.ann_job == job)
+    if ann is None:
+        return
+
+    # файл пишем вне лока, а на место его ставим (и чистим старые ревизии) под локом,
+    # только пока ревизия актуальна; сохранение best-effort, как и кэш матрицы
+    p = _ann_path(rev)
+    tmp: Optional[Path] = p.with_suffix(".tmp")
+    try:
+        VECTOR_DIR.mkdir(parents=True, exist_ok=True)
+        faiss.write_index(ann, str(tmp))
+    except (OSError, RuntimeError):
+        tmp = None
+
+    with state.write_lock:
+        index = state.index
+        if state.ann_job != job or index is None or index.emb_rev != rev or index.ann_rows != ann.ntotal:
+            # за время сборки индекс перечитали с новой ревизией — граф уже ни к чему
+            if tmp is not None:
+                tmp.unlink(missing_ok=True)
+            return
+        state.ann_job = None
+        # для нового графа устарели только строки, отмеченные /store после начала сборки
+        # (с байта stale_from файла .stale); не прочитали — берём все, это лишь лишний перебор
+        sp = _ann_stale_path(rev)
+        try:
+            stale = np.unique(np.fromfile(sp, dtype=np.int64, offset=stale_from)) if sp.exists() else index.ann_stale[:0]
+        except OSError:
+            stale = index.ann_stale
+        if tmp is not None:
+            try:
+                os.replace(tmp, p)
+                _remove_stale("hnsw.*.faiss", keep=p)
+                _remove_stale("hnsw.*.stale", keep=sp)
+                if stale_from:
+                    # до этой замены на диске новый граф с полным .stale — тоже корректно
+                    sp_tmp = VECTOR_DIR / f"hnsw.{rev}.stale.tmp"
+                    stale.tofile(sp_tmp)
+                    os.replace(sp_tmp, sp)
+            except OSError:
+                pass
+        state.index = replace(index, ann=ann, ann_stale=stale)
+
+
+def _mark_ann_stale(rev: str, row: int) -> None:
+    """Отмечает строку графа как перезаписанную (до записи нового вектора в кэш)."""
+    VECTOR_DIR.mkdir(parents=True, exist_ok=True)
+    with _ann_stale_path(rev).open("ab") as f:
+        f.write(np.int64(row).tobytes())
+
+
+def _write_emb_row(rev: str, row: int, v: np.ndarray) -> None:
+    """Перезаписывает строку row кэш-файла (row == N -> дописывает в конец)."""
+    p = _emb_cache_path(rev)
+    nbytes = v.shape[0] * 4
+    with p.open("r+b") as f:
+        size = f.seek(0, os.SEEK_END)
+        if row * nbytes > size:
+            raise RuntimeError(f"emb cache out of sync: row {row}, {size} bytes")
+        f.seek(row * nbytes)
+        f.write(v.astype(np.float32, copy=False).tobytes())
+
+
+def _encode_labels(values: List[str]) -> Tuple[np.ndarray, Dict[str, int]]:
+    vocab, codes = np.unique(np.asarray(values, dtype=object), return_inverse=True)
+    return codes.astype(np.int16), {str(v): i for i, v in enumerate(vocab)}
+
+
+def _use_i8(n: int) -> bool:
+    # int8-копия держится в памяти, только когда по ней реально пойдёт поиск
+    return _topk_i8 is not None and n >= QUANT_MIN_ROWS
+
+
+def _quantize_i8(emb_matrix: np.ndarray) -> np.ndarray:
+    # векторы нормализованы -> компоненты в [-1, 1], одной шкалы 127 достаточно
+    out = np.empty(emb_matrix.shape, dtype=np.int8)
+    for i in range(0, emb_matrix.shape[0], I8_BLOCK):
+        blk = np.rint(emb_matrix[i:i + I8_BLOCK] * 127.0)
+        np.clip(blk, -127, 127, out=blk)
+        out[i:i + I8_BLOCK] = blk
+    return out
+
+
+def _build_emb_matrix(con: sqlite3.Connection, n: int, dim: int) -> np.ndarray:
+    # построчно из курсора прямо в заранее выделенную матрицу: без fetchall и vstack
+    emb_matrix = np.empty((n, dim), dtype=np.float32)
+    i = 0
+    for (emb_blob,) in con.execute(
+        "SELECT e.emb FROM rag_chunks c JOIN rag_embs e ON e.id = c.id ORDER BY c.rowid"
+    ):
+        if i >= n:
+            raise RuntimeError(f"rag_chunks changed during load: more than {n} rows")
+        emb_matrix[i] = np.frombuffer(emb_blob, dtype=np.float32, count=dim)
+        i += 1
+
+    if i != n:
+        raise RuntimeError(f"rag_chunks changed during load: {i} rows, expected {n}")
+
+    # ingest и /store пишут уже нормализованные векторы; страховка — один векторный проход
+    norms = np.einsum("ij,ij->i", emb_matrix, emb_matrix)
+    np.sqrt(norms, out=norms)
+    norms[norms == 0] = 1.0
+    emb_matrix /= norms[:, None]
+    return emb_matrix
+
+
+def _load_index_from_db(rebuild: bool = False) -> RagIndex:
+    """
+    Метаданные читаются из БД всегда, матрица эмбеддингов — из кэш-файла (memmap),
+    если он соответствует текущим emb_rev и emb_writes. rebuild=True принудительно пересобирает кэш из БД.
+    """
     if not DB_PATH.exists():
         raise FileNotFoundError(f"rag.db not found: {DB_PATH.resolve()}")
 
@@ -122,46 +517,57 @@ def _load_index_from_db() -> RagIndex:
     try:
         # на всякий случай: если сервис подняли на старой БД
         _ensure_schema(con)
+        rev = _bump_emb_rev(con) if rebuild else _get_emb_rev(con)
         con.commit()
 
+        # одна read-транзакция: метаданные и эмбеддинги из одного снимка
+        con.execute("BEGIN")
+        writes = _get_emb_writes(con)
         cur = con.cursor()
         cur.execute(
-            "SELECT source_path, kind, chunk_index, priority, text, emb, dim FROM rag_chunks"
+            "SELECT source_path, kind, chunk_index, priority, text, dim FROM rag_chunks ORDER BY rowid"
         )
         rows = cur.fetchall()
+
+        if not rows:
+            raise RuntimeError("rag_chunks is empty")
+
+        source_path: List[str] = []
+        kind: List[str] = []
+        chunk_index: List[int] = []
+        priority: List[str] = []
+        text: List[str] = []
+
+        dim0 = int(rows[0][5])
+        for sp, k, idx, pr, t, dim in rows:
+            dim = int(dim)
+            if dim != dim0:
+                raise RuntimeError(f"Inconsistent dim in DB: got {dim}, expected {dim0}")
+
+            source_path.append(str(sp))
+            kind.append(str(k))
+            chunk_index.append(int(idx))
+            pr_s = str(pr) if pr is not None else "normal"
+            priority.append(pr_s if pr_s in PRIORITIES else "normal")
+            text.append(str(t))
+
+        emb_matrix = _open_emb_cache(rev, len(rows), dim0, writes)
+        if emb_matrix is None:
+            emb_matrix = _save_emb_cache(rev, _build_emb_matrix(con, len(rows), dim0), writes)
+            # граф этой ревизии мог строиться по разошедшемуся с БД кэшу — пусть строится заново
+            _drop_ann(rev)
+        con.rollback()
     finally:
         con.close()
 
-    if not rows:
-        raise RuntimeError("rag_chunks is empty")
-
-    source_path: List[str] = []
-    kind: List[str] = []
-    chunk_index: List[int] = []
-    priority: List[str] = []
-    text: List[str] = []
-    embs: List[np.ndarray] = []
-
-    dim0 = int(rows[0][6])
-    for sp, k, idx, pr, t, emb_blob, dim in rows:
-        dim = int(dim)
-        if dim != dim0:
-            raise RuntimeError(f"Inconsistent dim in DB: got {dim}, expected {dim0}")
-
-        v = np.frombuffer(emb_blob, dtype=np.float32, count=dim)
-        norm = float(np.linalg.norm(v))
-        if norm > 0:
-            v = v / norm
-
-        source_path.append(str(sp))
-        kind.append(str(k))
-        chunk_index.append(int(idx))
-        pr_s = str(pr) if pr is not None else "normal"
-        priority.append(pr_s if pr_s in PRIORITIES else "normal")
-        text.append(str(t))
-        embs.append(v)
-
-    emb_matrix = np.vstack(embs).astype(np.float32, copy=False)
+    kind_codes, kind_vocab = _encode_labels(kind)
+    emb_i8 = _quantize_i8(emb_matrix) if _use_i8(len(rows)) else None
+    ann, ann_stale = None, np.empty(0, dtype=np.int64)
+    ann_rows = 0
+    if _use_ann(len(rows)):
+        ann, ann_stale = _open_ann(rev, len(rows), dim0)
+        # без готового графа он строится в фоне по всем строкам (_set_index)
+        ann_rows = int(ann.ntotal) if ann is not None else len(rows)
 
     return RagIndex(
         source_path=source_path,
@@ -170,12 +576,273 @@ def _load_index_from_db() -> RagIndex:
         priority=priority,
         text=text,
         emb_matrix=emb_matrix,
+        emb_rev=rev,
+        emb_i8=emb_i8,
+        kind_codes=kind_codes,
+        kind_vocab=kind_vocab,
+        row_of={key: i for i, key in enumerate(zip(source_path, kind, chunk_index))},
+        ann=ann,
+        ann_stale=ann_stale,
+        ann_rows=ann_rows,
+    )
+
+
+def _append_row(arr: np.ndarray, row: np.ndarray) -> np.ndarray:
+    """
+    Дописывает row в конец arr. arr — префикс-view буфера с запасом;
+    когда запас кончается, буфер удваивается (амортизированно O(D) на строку).
+    """
+    n = int(arr.shape[0])
+    buf = arr.base
+    if not (isinstance(buf, np.ndarray) and buf.shape[1:] == arr.shape[1:] and buf.shape[0] > n):
+        buf = np.empty((max(2 * n, 16),) + arr.shape[1:], dtype=arr.dtype)
+        buf[:n] = arr
+    buf[n] = row
+    return buf[: n + 1]
+
+
+def _apply_store(index: RagIndex, key: Tuple[str, str, int], priority: str, text: str, v: np.ndarray) -> RagIndex:
+    """
+    Вносит сохранённый /store чанк в индекс без перечитывания БД.
+    Строка в кэш-файле эмбеддингов к этому моменту уже записана (_write_emb_row).
+    """
+    row = index.row_of.get(key)
+    if row is not None:
+        # emb_matrix — memmap на тот же файл, новую строку он уже видит
+        index.priority[row] = priority
+        index.text[row] = text
+        if index.emb_i8 is not None:
+            index.emb_i8[row] = _quantize_i8(v[None, :])[0]
+        if row < index.ann_rows:
+            # в HNSW вектор не заменить: граф оставляем, строку ищем перебором, как хвост
+            return replace(index, ann_stale=np.union1d(index.ann_stale, [row]).astype(np.int64))
+        return index
+
+    n = len(index.text) + 1
+    emb_matrix = _map_emb_cache(index.emb_rev, n, int(v.shape[0]))
+    if emb_matrix is None:
+        raise RuntimeError("emb cache out of sync after append")
+
+    sp, k, idx = key
+    code = index.kind_vocab.setdefault(k, len(index.kind_vocab))
+    index.source_path.append(sp)
+    index.kind.append(k)
+    index.chunk_index.append(idx)
+    index.priority.append(priority)
+    index.text.append(text)
+    index.row_of[key] = n - 1
+
+    if index.emb_i8 is not None:
+        emb_i8 = _append_row(index.emb_i8, _quantize_i8(v[None, :])[0])
+    else:
+        # порог QUANT_MIN_ROWS перейдён этой строкой — квантуем один раз целиком
+        emb_i8 = _quantize_i8(emb_matrix) if _use_i8(n) else None
+
+    # граф не трогаем (faiss add не потокобезопасен с search): новая строка попадает в хвост перебора.
+    # списки общие и только растут; массивы подменяем одним новым RagIndex,
+    # чтобы параллельный retrieve видел согласованные emb_matrix / emb_i8 / kind_codes
+    return replace(
+        index,
+        emb_matrix=emb_matrix,
+        emb_i8=emb_i8,
+        kind_codes=_append_row(index.kind_codes, np.int16(code)),
     )
 
 
+def _set_index(index: RagIndex) -> None:
+    state.index = index
+    state.loaded_at = time.time()
+    if index.ann is not None or index.ann_rows == 0:
+        state.ann_job = None  # идущая сборка старой ревизии остановится
+    elif state.ann_job is None or state.ann_job[0] != index.emb_rev:
+        _start_ann_build(index)
+
+
+def _start_ann_build(index: RagIndex) -> None:
+    """
+    Сборка графа по всем строкам index — десятки секунд на больших N: в фоне, а до готовности
+    ищем по старому графу или int8 / точным перебором. Одна сборка за раз: прежняя
+    (другой ревизии) остановится на следующем блоке. Вызывать под write_lock (или до старта сервиса).
+    """
+    state.ann_gen += 1
+    state.ann_job = (index.emb_rev, state.ann_gen)
+    sp = _ann_stale_path(index.emb_rev)
+    stale_from = sp.stat().st_size if sp.exists() else 0
+    # строки, перезаписанные /store во время сборки, устарели и для нового графа
+    state.index = replace(index, ann_rows=len(index.text))
+    threading.Thread(
+        target=_ann_worker, args=(state.ann_job, index.emb_matrix, stale_from), daemon=True
+    ).start()
+
+
+# ----------------------------
+# Search
+# ----------------------------
+def _top_idx(scores: np.ndarray, k: int) -> np.ndarray:
+    """Индексы k лучших скоров по убыванию."""
+    if k == 1:
+        return np.array([int(np.argmax(scores))])
+    n = int(scores.shape[0])
+    # kth считаем на самом scores: без N-размерного -scores на горячем пути
+    idx = np.argpartition(scores, n - k)[n - k:] if k < n else np.arange(n)
+    return idx[np.argsort(-scores[idx])]
+
+
+if numba is not None:
+
+    @njit(parallel=True, cache=True, fastmath=True)
+    def _topk_cosine(emb, q, k, nblk):
+        """
+        Скалярные произведения + top-k за один проход, без N-размерного массива скоров.
+        Каждый блок строк держит свой отсортированный top-k, в конце блоки сливаются.
+        """
+        n, d = emb.shape
+        step = (n + nblk - 1) // nblk
+        # косинус >= -1, так что -2 — «пустой» слот (без inf: fastmath)
+        blk_s = np.full((nblk, k), -2.0, dtype=np.float32)
+        blk_i = np.zeros((nblk, k), dtype=np.int64)
+        for b in prange(nblk):
+            s_top = blk_s[b]
+            i_top = blk_i[b]
+            for r in range(b * step, min(n, (b + 1) * step)):
+                acc = np.float32(0.0)
+                for j in range(d):
+                    acc += emb[r, j] * q[j]
+                if acc > s_top[k - 1]:
+                    p = k - 1
+                    while p > 0 and s_top[p - 1] < acc:
+                        s_top[p] = s_top[p - 1]
+                        i_top[p] = i_top[p - 1]
+                        p -= 1
+                    s_top[p] = acc
+                    i_top[p] = r
+        flat_s = blk_s.ravel()
+        flat_i = blk_i.ravel()
+        order = np.argsort(-flat_s)[:k]
+        return flat_s[order], flat_i[order]
+
+    @njit(parallel=True, cache=True)
+    def _topk_i8(emb, q, rows, k, nblk):
+        """
+        То же по int8-копии: произведения int8 x int8 копятся в int32, без перевода матрицы во float.
+        rows — подмножество строк (фильтр по kind), пустой массив — вся матрица.
+        """
+        use_rows = rows.shape[0] > 0
+        n = rows.shape[0] if use_rows else emb.shape[0]
+        d = emb.shape[1]
+        step = (n + nblk - 1) // nblk
+        # |скор| <= D * 127 * 127, до границы int32 далеко
+        blk_s = np.full((nblk, k), -2147483647, dtype=np.int32)
+        blk_i = np.zeros((nblk, k), dtype=np.int64)
+        for b in prange(nblk):
+            s_top = blk_s[b]
+            i_top = blk_i[b]
+            for t in range(b * step, min(n, (b + 1) * step)):
+                r = rows[t] if use_rows else t
+                acc = np.int32(0)
+                for j in range(d):
+                    acc += np.int32(emb[r, j]) * np.int32(q[j])
+                if acc > s_top[k - 1]:
+                    p = k - 1
+                    while p > 0 and s_top[p - 1] < acc:
+                        s_top[p] = s_top[p - 1]
+                        i_top[p] = i_top[p - 1]
+                        p -= 1
+                    s_top[p] = acc
+                    i_top[p] = r
+        flat_s = blk_s.ravel()
+        flat_i = blk_i.ravel()
+        order = np.argsort(-flat_s)[:k]
+        return flat_s[order], flat_i[order]
+
+else:
+    _topk_cosine = None
+    _topk_i8 = None
+
+_ALL_ROWS = np.empty(0, dtype=np.int64)
+
+
+def _numba_blocks(n: int, k: int) -> int:
+    return max(1, min(n // k, numba.get_num_threads() * NUMBA_BLOCKS_PER_THREAD))
+
+
+def _topk_numba(emb_matrix: np.ndarray, qv: np.ndarray, k: int) -> Tuple[np.ndarray, np.ndarray]:
+    n = int(emb_matrix.shape[0])
+    # np.asarray: memmap -> обычный ndarray без копии, чтобы numba не спотыкалась о подкласс
+    scores, idx = _topk_cosine(np.asarray(emb_matrix), np.ascontiguousarray(qv), k, _numba_blocks(n, k))
+    return idx, scores
+
+
+def _cand_i8(emb_i8: np.ndarray, qv: np.ndarray, k: int, rows: Optional[np.ndarray]) -> np.ndarray:
+    """Глобальные индексы k лучших строк по int8-скорам (кандидаты на fp32-пересчёт)."""
+    n = int(emb_i8.shape[0]) if rows is None else int(rows.shape[0])
+    # запрос тоже в int8, со своим масштабом: порядок кандидатов от масштаба не зависит
+    q_i8 = np.rint(qv * (127.0 / max(float(np.abs(qv).max()), 1e-12))).astype(np.int8)
+    _, idx = _topk_i8(emb_i8, q_i8, _ALL_ROWS if rows is None else rows, k, _numba_blocks(n, k))
+    return idx
+
+
+def _rerank(index: RagIndex, qv: np.ndarray, cand: np.ndarray, topk: int) -> Tuple[np.ndarray, np.ndarray]:
+    """Точные fp32-скоры для кандидатов -> (глобальные индексы, скоры) top-k по убыванию."""
+    cand = np.unique(cand)  # заодно сортировка — последовательное чтение memmap
+    scores = index.emb_matrix[cand] @ qv
+    top = _top_idx(scores, min(topk, int(cand.shape[0])))
+    return cand[top], scores[top]
+
+
+def _search(
+    index: RagIndex, qv: np.ndarray, topk: int, rows: Optional[np.ndarray] = None
+) -> Tuple[np.ndarray, np.ndarray]:
+    """
+    Top-k по косинусу: (глобальные индексы строк, скоры) по убыванию.
+    rows — подмножество строк (фильтр по kind), None — вся матрица.
+    """
+    n = int(index.emb_matrix.shape[0]) if rows is None else int(rows.shape[0])
+    topk = min(topk, n)
+
+    if rows is None and index.ann is not None:
+        m = int(index.ann.ntotal)
+        _, found = index.ann.search(qv[None, :], min(max(RERANK_TOPN, topk * CAND_OVERSAMPLE), m))
+        found = found[0]
+        cand = np.concatenate([found[found >= 0], index.ann_stale, np.arange(m, n)])
+        return _rerank(index, qv, cand, topk)
+
+    if n >= QUANT_MIN_ROWS and index.emb_i8 is not None:
+        cand = _cand_i8(index.emb_i8, qv, min(max(RERANK_TOPN, topk * CAND_OVERSAMPLE), n), rows)
+        return _rerank(index, qv, cand, topk)
+
+    if rows is None:
+        if _topk_cosine is not None:
+            return _topk_numba(index.emb_matrix, qv, topk)
+        scores = index.emb_matrix @ qv
+        top = _top_idx(scores, topk)
+        return top, scores[top]
+
+    scores = index.emb_matrix[rows] @ qv
+    top = _top_idx(scores, topk)
+    return rows[top], scores[top]
+
+
 # ----------------------------
 # Lifecycle
 # ----------------------------
+def _check_numba() -> None:
+    """
+    Компиляция (или загрузка из cache) ядер до первого запроса. Заодно грузится threading layer:
+    если потокобезопасного (tbb / omp) нет — ядра выключаем, поиск идёт через GEMV + _top_idx.
+    Зовётся до загрузки индекса: emb_i8 строится, только если int8-ядро доступно (_use_i8).
+    """
+    global _topk_cosine, _topk_i8
+    if _topk_cosine is None:
+        return
+    try:
+        _topk_numba(np.zeros((1, 1), dtype=np.float32), np.zeros(1, dtype=np.float32), 1)
+        _cand_i8(np.zeros((1, 1), dtype=np.int8), np.ones(1, dtype=np.float32), 1, None)
+    except ValueError:  # "No threading layer could be loaded"
+        _topk_cosine = None
+        _topk_i8 = None
+
+
 @app.on_event("startup")
 def _startup() -> None:
     if DB_PATH.exists():
@@ -186,11 +853,12 @@ def _startup() -> None:
         finally:
             con.close()
 
-    state.model = SentenceTransformer(MODEL_NAME)
-    _ = state.model.encode(["warmup"], normalize_embeddings=True)
+    state.model = _load_encoder()
+    with torch.inference_mode():
+        _ = state.model.encode(["warmup"], normalize_embeddings=True)
 
-    state.index = _load_index_from_db()
-    state.loaded_at = time.time()
+    _check_numba()
+    _set_index(_load_index_from_db())
 
 
 # ----------------------------
@@ -202,6 +870,8 @@ def health():
         "status": "ok" if state.ready() else "starting",
         "db_path": str(DB_PATH),
         "model": MODEL_NAME,
+        "encoder": "onnx" if isinstance(state.model, OnnxEncoder) else "torch",
+        "numba": _topk_cosine is not None,
         "model_loaded": state.model is not None,
         "index_loaded": state.index is not None,
         "loaded_at": state.loaded_at,
@@ -215,8 +885,8 @@ def reload_index():
     if state.model is None:
         raise HTTPException(status_code=503, detail="Model not loaded yet")
     try:
-        state.index = _load_index_from_db()
-        state.loaded_at = time.time()
+        with state.write_lock:
+            _set_index(_load_index_from_db(rebuild=True))
         return {"ok": True, "chunks": int(state.index.emb_matrix.shape[0])}
     except Exception as e:
         raise HTTPException(status_code=500, detail=f"Reload failed: {e}")
@@ -227,13 +897,15 @@ def store(req: StoreRequest):
     if not state.ready():
         raise HTTPException(status_code=503, detail="Service not ready")
     assert state.model is not None
+    assert state.index is not None
 
     pr = (req.priority or "normal").strip().lower()
     if pr not in PRIORITIES:
         raise HTTPException(status_code=422, detail=f"Invalid priority: {req.priority}. Use 'normal' or 'high'.")
 
     try:
-        v = state.model.encode([req.text], normalize_embeddings=True)[0].astype(np.float32, copy=False)
+        with torch.inference_mode():
+            v = state.model.encode([req.text], normalize_embeddings=True)[0].astype(np.float32, copy=False)
     except Exception as e:
         raise HTTPException(status_code=500, detail=f"Embedding failed: {e}")
 
@@ -243,59 +915,91 @@ def store(req: StoreRequest):
     new_id = uuid.uuid4().hex
     created_at = datetime.now(timezone.utc).isoformat()
 
-    con = _db_connect()
-    try:
-        _ensure_schema(con)
-        cur = con.cursor()
+    key = (req.source_path, req.kind, int(req.chunk_index))
 
-        cur.execute(
-            """
-            INSERT INTO rag_chunks (id, source_path, kind, chunk_index, priority, text, emb, dim, created_at)
-            VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?)
-            ON CONFLICT(source_path, kind, chunk_index) DO UPDATE SET
-                priority = excluded.priority,
-                text = excluded.text,
-                emb = excluded.emb,
-                dim = excluded.dim,
-                created_at = excluded.created_at
-            """,
-            (
-                new_id,
-                req.source_path,
-                req.kind,
-                int(req.chunk_index),
-                pr,
-                req.text,
-                emb_blob,
-                dim,
-                created_at,
-            ),
-        )
-        con.commit()
+    with state.write_lock:
+        index = state.index
 
-        cur.execute(
-            "SELECT id, dim FROM rag_chunks WHERE source_path=? AND kind=? AND chunk_index=?",
-            (req.source_path, req.kind, int(req.chunk_index)),
-        )
-        row = cur.fetchone()
-        if not row:
-            raise HTTPException(status_code=500, detail="Store succeeded but row not found")
-        stored_id, stored_dim = row[0], int(row[1])
+        con = _db_connect()
+        try:
+            _ensure_schema(con)
+            cur = con.cursor()
+
+            cur.execute(
+                """
+                INSERT INTO rag_chunks (id, source_path, kind, chunk_index, priority, text, dim, created_at)
+                VALUES (?, ?, ?, ?, ?, ?, ?, ?)
+                ON CONFLICT(source_path, kind, chunk_index) DO UPDATE SET
+                    priority = excluded.priority,
+                    text = excluded.text,
+                    dim = excluded.dim,
+                    created_at = excluded.created_at
+                """,
+                (
+                    new_id,
+                    req.source_path,
+                    req.kind,
+                    int(req.chunk_index),
+                    pr,
+                    req.text,
+                    dim,
+                    created_at,
+                ),
+            )
 
-    except sqlite3.IntegrityError as e:
-        con.rollback()
-        raise HTTPException(status_code=409, detail=f"Integrity error: {e}")
-    except sqlite3.Error as e:
-        con.rollback()
-        raise HTTPException(status_code=500, detail=f"DB error: {e}")
-    finally:
-        con.close()
+            cur.execute(
+                "SELECT id, dim FROM rag_chunks WHERE source_path=? AND kind=? AND chunk_index=?",
+                key,
+            )
+            row = cur.fetchone()
+            if not row:
+                raise HTTPException(status_code=500, detail="Store succeeded but row not found")
+            stored_id, stored_dim = row[0], int(row[1])
+
+            # при UPDATE id остаётся прежним — эмбеддинг пишем под него
+            cur.execute(
+                "INSERT INTO rag_embs (id, emb) VALUES (?, ?) "
+                "ON CONFLICT(id) DO UPDATE SET emb = excluded.emb",
+                (stored_id, emb_blob),
+            )
 
-    try:
-        state.index = _load_index_from_db()
-        state.loaded_at = time.time()
-    except Exception as e:
-        raise HTTPException(status_code=500, detail=f"Stored but reload_index failed: {e}")
+            writes = _bump_emb_writes(con)
+            rev = _get_emb_rev(con)
+            con.commit()
+
+        except sqlite3.IntegrityError as e:
+            con.rollback()
+            raise HTTPException(status_code=409, detail=f"Integrity error: {e}")
+        except sqlite3.Error as e:
+            con.rollback()
+            raise HTTPException(status_code=500, detail=f"DB error: {e}")
+        finally:
+            con.close()
+
+        # новая строка встаёт в конец порядка rowid, обновлённая остаётся на своём месте
+        emb_row = index.row_of.get(key, len(index.text))
+        try:
+            if rev != index.emb_rev:
+                raise RuntimeError("emb cache revision changed")
+            if emb_row < index.ann_rows:
+                # до записи вектора: после сбоя между ними строка просто лишний раз попадёт в перебор
+                _mark_ann_stale(rev, emb_row)
+            _write_emb_row(rev, emb_row, v)
+            _save_emb_writes(rev, writes)
+            state.index = index = _apply_store(index, key, pr, req.text, v)
+            if (
+                index.ann is not None
+                and state.ann_job is None
+                and _ann_tail_too_long(len(index.text), int(index.ann.ntotal), int(index.ann_stale.shape[0]))
+            ):
+                # перебор хвоста растёт с каждым /store — пересобираем граф, пока ищем по старому
+                _start_ann_build(index)
+        except (OSError, RuntimeError):
+            # кэш разошёлся с БД (ingest, сбой записи) — полная пересборка
+            try:
+                _set_index(_load_index_from_db(rebuild=True))
+            except Exception as e:
+                raise HTTPException(status_code=500, detail=f"Stored but reload_index failed: {e}")
 
     return StoreResponse(ok=True, id=str(stored_id), dim=int(stored_dim))
 
@@ -308,33 +1012,23 @@ def retrieve(q: Query):
     assert state.index is not None
 
     try:
-        qv = state.model.encode([q.query], normalize_embeddings=True)[0].astype(np.float32, copy=False)
+        with torch.inference_mode():
+            qv = state.model.encode([q.query], normalize_embeddings=True)[0].astype(np.float32, copy=False)
     except Exception as e:
         raise HTTPException(status_code=500, detail=f"Embedding failed: {e}")
 
-    topk_req = int(q.topk)
+    index = state.index
 
+    rows: Optional[np.ndarray] = None
     if q.kind:
-        mask = np.fromiter((k == q.kind for k in state.index.kind), dtype=bool)
-        if not mask.any():
+        code = index.kind_vocab.get(q.kind)
+        if code is None:
+            return []
+        rows = np.flatnonzero(index.kind_codes == code)
+        if rows.size == 0:
             return []
 
-        embs = state.index.emb_matrix[mask]
-        scores_local = embs @ qv
-
-        topk = min(topk_req, int(scores_local.shape[0]))
-        idx_local = np.argpartition(-scores_local, kth=topk - 1)[:topk]
-        idx_local = idx_local[np.argsort(-scores_local[idx_local])]
-
-        idx_global_all = np.flatnonzero(mask)
-        idx_global = idx_global_all[idx_local]
-        scores_sorted = scores_local[idx_local]
-    else:
-        scores = state.index.emb_matrix @ qv
-        topk = min(topk_req, int(scores.shape[0]))
-        idx_global = np.argpartition(-scores, kth=topk - 1)[:topk]
-        idx_global = idx_global[np.argsort(-scores[idx_global])]
-        scores_sorted = scores[idx_global]
+    idx_global, scores_sorted = _search(index, qv, int(q.topk), rows)
 
     out: List[RetrievedChunk] = []
     for rank, gi in enumerate(idx_global):
@@ -342,11 +1036,11 @@ def retrieve(q: Query):
         out.append(
             RetrievedChunk(
                 score=float(scores_sorted[rank]),
-                source_path=state.index.source_path[i],
-                kind=state.index.kind[i],
-                chunk_index=state.index.chunk_index[i],
-                priority=state.index.priority[i],
-                text=state.index.text[i],
+                source_path=index.source_path[i],
+                kind=index.kind[i],
+                chunk_index=index.chunk_index[i],
+                priority=index.priority[i],
+                text=index.text[i],
             )
         )
     return out
\ No newline at end of file
@@ -7,9 +7,6 @@ BASE = Path("farm_memory")
 DB_PATH = BASE / "db" / "rag.db"
 MODEL_NAME = "sentence-transformers/paraphrase-multilingual-MiniLM-L12-v2"
 
-def from_blob(b: bytes, dim: int) -> np.ndarray:
-    return np.frombuffer(b, dtype=np.float32, count=dim)
-
 def main():
     q = "Что мы завели сегодня?"
     topk = 5
@@ -18,8 +15,12 @@ def main():
     qv = model.encode([q], normalize_embeddings=True)[0].astype(np.float32)
 
     con = sqlite3.connect(DB_PATH)
+    con.execute("PRAGMA mmap_size = 1073741824")
     cur = con.cursor()
-    cur.execute("SELECT id, source_path, kind, chunk_index, text, emb, dim FROM rag_chunks")
+    cur.execute("""
+        SELECT c.id, c.source_path, c.kind, c.chunk_index, c.text, e.emb, c.dim
+        FROM rag_chunks c JOIN rag_embs e ON e.id = c.id
+    """)
     rows = cur.fetchall()
     con.close()
 
@@ -27,16 +28,22 @@ def main():
         print("Пусто: сначала запусти ingest_rag_sqlite.py")
         return
 
-    scored = []
-    for _id, sp, kind, idx, text, emb_blob, dim in rows:
-        v = from_blob(emb_blob, dim)
-        score = float(np.dot(qv, v))  # cosine, т.к. нормализовано
-        scored.append((score, sp, kind, idx, text))
+    dim = int(rows[0][6])
+    if any(int(r[6]) != dim for r in rows):
+        raise RuntimeError("Inconsistent dim in DB")
+
+    # одна матрица (N, D) и один GEMV вместо np.dot по строкам
+    embs = np.frombuffer(b"".join(r[5] for r in rows), dtype=np.float32).reshape(len(rows), dim)
+    scores = embs @ qv  # cosine, т.к. нормализовано
 
-    scored.sort(key=lambda x: x[0], reverse=True)
+    k = min(topk, len(rows))
+    top = np.argpartition(scores, len(rows) - k)[len(rows) - k:]
+    top = top[np.argsort(-scores[top])]
 
     print("Q:", q)
-    for score, sp, kind, idx, text in scored[:topk]:
+    for i in top:
+        _id, sp, kind, idx, text, _emb, _dim = rows[i]
+        score = float(scores[i])
         print("-"*60)
         print(f"{score:.4f}  {sp}  ({kind} #{idx})")
         print(text[:300].replace("\n"," "))